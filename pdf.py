@@ -1,10 +1,32 @@
 import os
 import sys
+import asyncio
+import logging
+import random
+import time
+import collections
+import hashlib
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 import google.generativeai as genai
 from google.api_core import exceptions as google_exceptions
-from PIL import Image # Still useful for getting MIME type from bytes if needed
+from PIL import Image # Used to encode rendered pages as JPEG
 import io             # To handle image bytes in memory
 import fitz           # PyMuPDF for handling PDFs
+from tqdm import tqdm
+from tqdm.contrib.logging import logging_redirect_tqdm
+
+try:
+    import pypdfium2 as pdfium # Optional: PDFium rasterizes pages faster than MuPDF
+except ImportError:
+    pdfium = None
+
+def read_env_number(name, default, cast):
+    """Reads a numeric environment variable, returning None if it is not a valid number."""
+    try:
+        return cast(os.environ.get(name, default))
+    except ValueError:
+        return None
 
 # --- Configuration ---
 INPUT_FOLDER = "Input"
@@ -12,17 +34,247 @@ OUTPUT_FOLDER = "Output"
 # Use a model that supports image analysis (like gemini-pro-vision or newer)
 # Using gemini-1.5-flash as it's generally available and efficient
 MODEL_NAME = "gemini-1.5-flash"
+# Prompt sent with every page image; tuned for handwriting recognition
+PROMPT = "Extract all handwritten and printed text visible in this image. Preserve the general layout if possible, but focus on accurate transcription. Provide only the extracted text."
 # Define the input extension we are looking for
 INPUT_EXTENSION = '.pdf'
+# Resolution used to render pages for OCR. Higher DPI uses more memory/time.
+RENDER_DPI = 150
+# Longest edge, in pixels, of the rendered page image. Larger pages are rendered at a lower DPI,
+# since Gemini downsizes big images internally and the extra pixels only slow down the upload.
+MAX_EDGE_PX = 2048
 # Define the intermediate image format (and its MIME type)
-# PNG is lossless and well-supported
-INTERMEDIATE_IMAGE_FORMAT = "png"
-INTERMEDIATE_MIME_TYPE = "image/png"
+# JPEG is several times smaller to upload and lossless quality is not needed for OCR.
+# Switch to "png" for line-art documents where JPEG artifacts hurt recognition.
+INTERMEDIATE_IMAGE_FORMAT = "jpeg"
+INTERMEDIATE_MIME_TYPE = "image/png" if INTERMEDIATE_IMAGE_FORMAT == "png" else "image/jpeg"
+# JPEG quality (1-95) used when INTERMEDIATE_IMAGE_FORMAT is "jpeg"
+JPEG_QUALITY = 85
+# Pages whose visible embedded text has more than this many characters are used as-is, skipping OCR
+MIN_NATIVE_TEXT_LENGTH = 50
+# Pages with a single image covering at least this fraction of the page are treated as scans and always OCRed
+SCANNED_PAGE_IMAGE_COVERAGE = 0.9
+# Set FORCE_OCR=1 to OCR every page, e.g. for scans that carry a junk text layer
+FORCE_OCR = os.environ.get("FORCE_OCR", "").lower() in ("1", "true", "yes")
+# OCR results are cached in this subfolder of the output folder, keyed by the PDF's contents and
+# page number, so reruns skip rendering and the API for unchanged pages
+CACHE_FOLDER_NAME = ".cache"
+# Write buffer size for output text files (1 MiB keeps large transcripts to a few syscalls)
+OUTPUT_BUFFER_SIZE = 1 << 20
+# Maximum number of Gemini requests allowed in flight at once
+MAX_CONCURRENCY = read_env_number("GEMINI_MAX_CONCURRENCY", "8", int)
+# Maximum number of Gemini requests per minute (60 suits the free tier; raise to ~500 on paid tiers)
+REQUESTS_PER_MINUTE = read_env_number("GEMINI_RPM", "60", float)
+# Maximum number of PDFs open at once. Pages from these share the API request pool.
+MAX_OPEN_PDFS = 4
+# Log level for this script's messages (DEBUG, INFO, WARNING or ERROR); DEBUG logs every page
+LOG_LEVELS = ("DEBUG", "INFO", "WARNING", "ERROR")
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
 # --- End Configuration ---
 
+log = logging.getLogger(__name__)
+
 # Note: get_mime_type function is no longer needed as we control the intermediate format
 
-def extract_text_from_image_data(image_data, mime_type, model, page_num, total_pages, pdf_filename):
+# Pages are rendered off the event loop so rasterization overlaps with API calls.
+# PyMuPDF is not thread-safe, so a single worker thread does all the rendering.
+RENDER_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="pdf-render")
+# Encode buffer reused for every page; only ever touched from the render thread
+_render_buffer = io.BytesIO()
+
+class AsyncRateLimiter:
+    """
+    Spaces out API calls so that no more than a fixed number start per minute.
+    """
+
+    def __init__(self, requests_per_minute):
+        self.min_interval = 60.0 / requests_per_minute
+        self.last_call = float("-inf")
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        """Waits until the next call is allowed to start."""
+        loop = asyncio.get_running_loop()
+        async with self._lock:
+            wait = self.last_call + self.min_interval - loop.time()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            self.last_call = loop.time()
+
+
+class AdaptiveSemaphore:
+    """
+    Caps the number of concurrent API calls, adapting the cap to the actual quota.
+
+    Sustained rate-limit errors (threshold or more within window seconds) halve the
+    cap; after recovery_interval seconds without one it grows back by one slot at
+    a time, up to max_concurrency (additive increase, multiplicative decrease).
+    """
+
+    def __init__(self, max_concurrency, window=10.0, threshold=5, recovery_interval=30.0):
+        self.max_concurrency = max_concurrency
+        self.limit = max_concurrency
+        self.window = window
+        self.threshold = threshold
+        self.recovery_interval = recovery_interval
+        self.recent_429 = collections.deque(maxlen=20)
+        self.last_change = float("-inf")
+        self._in_flight = 0
+        self._condition = asyncio.Condition()
+
+    async def __aenter__(self):
+        async with self._condition:
+            await self._condition.wait_for(lambda: self._in_flight < self.limit)
+            self._in_flight += 1
+
+    async def __aexit__(self, exc_type, exc, tb):
+        async with self._condition:
+            self._in_flight -= 1
+            # Wake every waiter: before Python 3.13 a single notify() is lost if the woken
+            # task is cancelled before it resumes, leaving a free slot idle. Waiters re-check
+            # the limit, and RENDER_SLOTS keeps their number small.
+            self._condition.notify_all()
+
+    def record_rate_limited(self):
+        """Records a rate-limit error and halves the cap if they keep occurring."""
+        now = time.monotonic()
+        self.recent_429.append(now)
+        recent = sum(1 for t in self.recent_429 if now - t <= self.window)
+        # Shrink at most once per window, so a single burst does not collapse the cap to 1
+        if recent >= self.threshold and self.limit > 1 and now - self.last_change >= self.window:
+            self.limit = max(1, self.limit // 2)
+            self.last_change = now
+            log.warning("Sustained rate limiting, reducing concurrency to %d.", self.limit)
+
+    async def record_success(self):
+        """Records a successful call and grows the cap by one after a quiet period."""
+        if self.limit >= self.max_concurrency:
+            return
+        now = time.monotonic()
+        last_429 = self.recent_429[-1] if self.recent_429 else float("-inf")
+        if now - max(last_429, self.last_change) >= self.recovery_interval:
+            self.limit += 1
+            self.last_change = now
+            log.info("No recent rate limiting, raising concurrency to %d.", self.limit)
+            async with self._condition:
+                self._condition.notify_all()
+
+
+# Shared by every page of every PDF so the limits apply to the whole run.
+# Created by init_limits() once main() has validated the configuration.
+SEM = None
+LIMITER = None
+RENDER_SLOTS = None
+PDF_SLOTS = None
+
+def init_limits():
+    """Creates the shared concurrency and rate limits from the configuration."""
+    global SEM, LIMITER, RENDER_SLOTS, PDF_SLOTS
+    SEM = AdaptiveSemaphore(MAX_CONCURRENCY)
+    LIMITER = AsyncRateLimiter(REQUESTS_PER_MINUTE)
+    # Pages rendered but not yet finished at the API. Twice the request cap keeps the
+    # next batch rendered while the current one is in flight, without rendering ahead further.
+    RENDER_SLOTS = asyncio.Semaphore(2 * MAX_CONCURRENCY)
+    PDF_SLOTS = asyncio.Semaphore(MAX_OPEN_PDFS)
+
+
+# Errors that are worth retrying because they are usually transient
+RETRYABLE_EXCEPTIONS = (
+    google_exceptions.ResourceExhausted,
+    google_exceptions.DeadlineExceeded,
+    google_exceptions.ServiceUnavailable,
+)
+
+def is_rate_limit_error(e):
+    """Returns True if an API error means the request or token quota was exhausted."""
+    if isinstance(e, google_exceptions.ResourceExhausted):
+        return True
+    # Some rate-limit errors surface as a plain GoogleAPIError tagged with HTTP 429
+    return isinstance(e, google_exceptions.GoogleAPIError) and getattr(e, "code", None) == 429
+
+
+def is_retryable_error(e):
+    """Returns True if an API error is transient (timeout, overload or rate limit)."""
+    return isinstance(e, RETRYABLE_EXCEPTIONS) or is_rate_limit_error(e)
+
+
+async def call_with_retry(coro_factory, attempts=3, base=2.0):
+    """
+    Awaits a fresh coroutine from coro_factory, retrying transient API errors
+    with exponential backoff (base, 2*base, 4*base... seconds plus jitter).
+
+    Args:
+        coro_factory (callable): Returns a new awaitable for each attempt.
+        attempts (int): Maximum number of attempts before giving up.
+        base (float): Delay in seconds before the first retry.
+
+    Returns:
+        The result of the first successful attempt. The last error is re-raised
+        if every attempt fails or the error is not retryable.
+    """
+    for i in range(attempts):
+        try:
+            return await coro_factory()
+        except google_exceptions.GoogleAPIError as e:
+            if i == attempts - 1 or not is_retryable_error(e):
+                raise
+            delay = base * 2 ** i + random.random()
+            log.warning("Transient API error (%s), retrying in %.1fs (attempt %d/%d)...", type(e).__name__, delay, i + 2, attempts)
+            await asyncio.sleep(delay)
+
+
+def hash_file(path):
+    """Returns a hex digest of a file's contents, read in 1 MiB chunks."""
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def get_cache_path(pdf_digest, page_index, cache_folder):
+    """
+    Returns the path in cache_folder for the OCR result of a PDF page.
+
+    The key is known before the page is rendered. Besides the PDF contents and page
+    number it covers the render settings, model and prompt, so changing any of them
+    invalidates the cache, while switching renderer or library versions does not.
+    """
+    key_parts = (
+        MODEL_NAME, PROMPT, pdf_digest, page_index,
+        RENDER_DPI, MAX_EDGE_PX, INTERMEDIATE_IMAGE_FORMAT, JPEG_QUALITY,
+    )
+    h = hashlib.blake2b(digest_size=16)
+    for part in key_parts:
+        h.update(str(part).encode("utf-8"))
+        h.update(b"\0")
+    return os.path.join(cache_folder, h.hexdigest() + ".txt")
+
+
+def read_cached_text(cache_path):
+    """Returns the cached text at cache_path, or None if there is no usable entry."""
+    try:
+        with open(cache_path, "r", encoding="utf-8") as f:
+            return f.read()
+    except (OSError, UnicodeDecodeError):
+        return None
+
+
+def write_cached_text(cache_path, text):
+    """Stores text at cache_path. Failures only cost a cache miss later, so they are not fatal."""
+    try:
+        cache_folder = os.path.dirname(cache_path)
+        os.makedirs(cache_folder, exist_ok=True)
+        # Write to a temporary file and rename, so an interrupted run never leaves a partial entry
+        fd, tmp_path = tempfile.mkstemp(dir=cache_folder, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(text.encode("utf-8"))
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        log.warning("Could not write cache file %s: %s", cache_path, e)
+
+
+async def extract_text_from_image_data(image_data, mime_type, model, page_num, total_pages, pdf_filename):
     """
     Extracts text from image data in memory using the Gemini API.
 
@@ -37,171 +289,390 @@ def extract_text_from_image_data(image_data, mime_type, model, page_num, total_p
     Returns:
         str: The extracted text, or None if an error occurred or no text found.
     """
-    print(f"  Processing Page {page_num}/{total_pages} of {pdf_filename}...")
+    log.debug("Processing Page %d/%d of %s...", page_num, total_pages, pdf_filename)
 
     try:
         # Prepare the content parts for the API request
-        image_part = {
-            "mime_type": mime_type,
-            "data": image_data
-        }
-        # Updated prompt for potentially better handwriting recognition
-        prompt_part = "Extract all handwritten and printed text visible in this image. Preserve the general layout if possible, but focus on accurate transcription. Provide only the extracted text."
-
-        # Make the API call
-        contents = [prompt_part, image_part]
+        contents = [PROMPT, {"mime_type": mime_type, "data": image_data}]
         # Increase timeout potential for complex images/handwriting
         request_options = {"timeout": 120} # 120 seconds timeout
-        response = model.generate_content(contents, request_options=request_options)
+
+        async def send_request():
+            # Hold a concurrency slot only while the request is in flight, not during retry backoff
+            async with SEM:
+                await LIMITER.acquire()
+                try:
+                    response = await model.generate_content_async(contents, request_options=request_options)
+                except google_exceptions.GoogleAPIError as e:
+                    if is_rate_limit_error(e):
+                        SEM.record_rate_limited()
+                    raise
+                await SEM.record_success()
+                return response
+
+        response = await call_with_retry(send_request)
 
 
         # --- Handle potential API blocking or errors ---
         if not response.candidates:
-            print(f"    Warning: No content generated for page {page_num} of {pdf_filename}, possibly due to safety filters or other issues.")
+            log.warning("No content generated for page %d of %s, possibly due to safety filters or other issues.", page_num, pdf_filename)
             try:
-                print(f"    Prompt Feedback: {response.prompt_feedback}")
+                log.warning("Prompt Feedback: %s", response.prompt_feedback)
             except (AttributeError, ValueError):
-                print("    (No detailed prompt feedback available)")
+                log.debug("(No detailed prompt feedback available)")
             return None
 
         # --- Extract text from the response ---
         try:
             if response.candidates[0].content.parts:
                 extracted_text = response.candidates[0].content.parts[0].text
-                print(f"    Text extracted successfully from page {page_num}.")
+                log.debug("Text extracted successfully from page %d of %s.", page_num, pdf_filename)
                 return extracted_text.strip() # Remove leading/trailing whitespace
             else:
                  # Fallback check for simpler response structures
                  if hasattr(response, 'text') and response.text:
-                    print(f"    Text extracted directly from response.text for page {page_num}.")
+                    log.debug("Text extracted directly from response.text for page %d of %s.", page_num, pdf_filename)
                     return response.text.strip()
                  else:
-                    print(f"    Warning: No text part found in the response structure for page {page_num} of {pdf_filename}.")
-                    # print(f"    Full Response Candidate: {response.candidates[0]}") # Uncomment for detailed debugging
+                    log.warning("No text part found in the response structure for page %d of %s.", page_num, pdf_filename)
+                    # log.debug("Full Response Candidate: %s", response.candidates[0]) # Uncomment for detailed debugging
                     return None
 
         except (AttributeError, IndexError, ValueError) as e:
-            print(f"    Error parsing response for page {page_num} of {pdf_filename}: {e}")
-            # print(f"    Full Response Candidate: {response.candidates[0]}") # Uncomment for detailed debugging
+            log.error("Error parsing response for page %d of %s: %s", page_num, pdf_filename, e)
+            # log.debug("Full Response Candidate: %s", response.candidates[0]) # Uncomment for detailed debugging
             return None
 
     except google_exceptions.GoogleAPIError as e:
         # Specific check for potential timeouts or resource exhaustion
         if isinstance(e, google_exceptions.DeadlineExceeded):
-             print(f"    API Error (Timeout) processing page {page_num} of {pdf_filename}: {e}")
+             log.error("API Error (Timeout) processing page %d of %s: %s", page_num, pdf_filename, e)
         elif isinstance(e, google_exceptions.ResourceExhausted):
-             print(f"    API Error (Resource Exhausted/Rate Limit) processing page {page_num} of {pdf_filename}: {e}")
+             log.error("API Error (Resource Exhausted/Rate Limit) processing page %d of %s: %s", page_num, pdf_filename, e)
         else:
-             print(f"    API Error processing page {page_num} of {pdf_filename}: {e}")
+             log.error("API Error processing page %d of %s: %s", page_num, pdf_filename, e)
         return None
     except Exception as e:
-        print(f"    An unexpected error occurred processing page {page_num} of {pdf_filename}: {e}")
+        log.error("An unexpected error occurred processing page %d of %s: %s", page_num, pdf_filename, e)
         return None
 
 
-def process_pdf(pdf_path, output_folder, model):
+def get_native_text(page):
     """
-    Processes a single PDF file, extracts text from each page, and saves combined text.
+    Returns the embedded text of a born-digital page, or "" if the page should be OCRed.
+
+    Scanner apps (e.g. Adobe Scan) place a full-page image under an invisible
+    text layer (render mode 3) produced by their own, much weaker, OCR. Only
+    visible text is trusted, and never on pages that are essentially one image.
 
     Args:
-        pdf_path (str): Path to the input PDF file.
-        output_folder (str): Path to the folder where the output text file will be saved.
-        model (genai.GenerativeModel): The configured Gemini model instance.
+        page (fitz.Page): The page to inspect.
 
     Returns:
-        bool: True if processing was successful, False otherwise.
+        str: The stripped page text, or "" if it should not be used.
     """
-    pdf_filename = os.path.basename(pdf_path)
-    print(f"\nProcessing PDF: {pdf_filename}...")
-    all_pages_text = []
-    processed_successfully = False # Track overall success for this PDF
+    page_area = page.rect.width * page.rect.height
+    for image in page.get_images():
+        for rect in page.get_image_rects(image[0]):
+            visible = rect & page.rect
+            if visible.width * visible.height >= SCANNED_PAGE_IMAGE_COVERAGE * page_area:
+                return ""
+
+    visible_chars = sum(len(span["chars"]) for span in page.get_texttrace() if span["type"] != 3)
+    if visible_chars <= MIN_NATIVE_TEXT_LENGTH:
+        return ""
+    return page.get_text("text").strip()
 
-    try:
-        # Open the PDF document
-        doc = fitz.open(pdf_path)
-        total_pages = len(doc)
-        print(f"Found {total_pages} page(s).")
 
-        # Iterate through each page
-        for page_num, page in enumerate(doc):
-            current_page_index = page_num + 1 # 1-based index for display
+class LazyPdfiumDocument:
+    """
+    Opens a PDF with pypdfium2 the first time a page of it needs rendering.
 
+    If pypdfium2 is not installed, or PDFium rejects a file that MuPDF could open
+    (MuPDF repairs damaged PDFs more leniently), get() returns None and the
+    pages are rendered with MuPDF instead. Only use it from the render thread.
+    """
+
+    def __init__(self, pdf_path):
+        self.pdf_path = pdf_path
+        self.doc = None
+        self.failed = pdfium is None
+
+    def get(self):
+        """Returns the PDFium document, or None if pages should be rendered with MuPDF."""
+        if self.doc is None and not self.failed:
             try:
-                # Render page to an image (pixmap) - increase resolution for better OCR if needed
-                # Default is 96 DPI. Higher DPI uses more memory/time. Try 150 or 200 if needed.
-                pix = page.get_pixmap(dpi=150)
-                # Convert pixmap to image bytes in the chosen format
-                img_data = pix.tobytes(output=INTERMEDIATE_IMAGE_FORMAT)
+                self.doc = pdfium.PdfDocument(self.pdf_path)
+            except pdfium.PdfiumError as e:
+                log.warning("PDFium could not open %s (%s), rendering it with PyMuPDF instead.", os.path.basename(self.pdf_path), e)
+                self.failed = True
+        return self.doc
+
+    def close(self):
+        """Closes the PDFium document if it was opened."""
+        if self.doc is not None:
+            self.doc.close()
+            self.doc = None
+
+
+def render_page(page, pdfium_source=None):
+    """
+    Renders a PDF page to image bytes in the intermediate format.
+
+    Args:
+        page (fitz.Page): The page to render.
+        pdfium_source (LazyPdfiumDocument, optional): The same PDF for pypdfium2.
+            When it can be opened, the page is rasterized with PDFium instead of MuPDF.
+
+    Returns:
+        bytes: The encoded image data.
+    """
+    # Lower the resolution for oversized pages so the longest edge fits within MAX_EDGE_PX
+    longest_edge_pt = max(page.rect.width, page.rect.height)
+    dpi = min(RENDER_DPI, int(MAX_EDGE_PX * 72 / longest_edge_pt))
+
+    pdfium_doc = pdfium_source.get() if pdfium_source is not None else None
+    if pdfium_doc is not None:
+        pdfium_page = pdfium_doc[page.number]
+        try:
+            img = pdfium_page.render(scale=dpi / 72).to_pil()
+        finally:
+            pdfium_page.close()
+    else:
+        # No alpha channel: OCR does not need it and it shrinks the pixel buffer by 25%
+        pix = page.get_pixmap(dpi=dpi, alpha=False)
+        if INTERMEDIATE_IMAGE_FORMAT == "png":
+            return pix.tobytes(output="png")
+        # Older PyMuPDF versions cannot set JPEG quality, so encode with Pillow instead.
+        # samples_mv is a view of MuPDF's pixel buffer (samples would copy it), and
+        # frombuffer wraps that view without copying it again.
+        img = Image.frombuffer("RGB", (pix.width, pix.height), pix.samples_mv, "raw", "RGB", pix.stride, 1)
+
+    # Convert the image to bytes in the chosen format
+    _render_buffer.seek(0)
+    _render_buffer.truncate()
+    if INTERMEDIATE_IMAGE_FORMAT == "png":
+        img.save(_render_buffer, "PNG")
+    else:
+        img.save(_render_buffer, "JPEG", quality=JPEG_QUALITY, optimize=True)
+    return _render_buffer.getvalue()
+
+
+async def process_page(page, pdfium_source, model, cache_folder, pdf_digest, page_index, total_pages, pdf_filename):
+    """
+    Extracts the text of a single PDF page, using its embedded text layer when
+    present and otherwise rendering it and running OCR.
+
+    Args:
+        page (fitz.Page): The page to process.
+        pdfium_source (LazyPdfiumDocument): The same PDF for rendering with pypdfium2.
+        model (genai.GenerativeModel): The configured Gemini model instance.
+        cache_folder (str): Folder holding cached OCR results.
+        pdf_digest (str): Hash of the PDF file, used to key the cache.
+        page_index (int): The current page number (1-based).
+        total_pages (int): Total number of pages in the PDF.
+        pdf_filename (str): The name of the source PDF file for logging.
+
+    Returns:
+        tuple[str, str]: The page separator and the page text. On failure the
+        separator is an error marker and the text is empty.
+    """
+    try:
+        loop = asyncio.get_running_loop()
+
+        # Born-digital pages already carry selectable text; no need to call the API
+        if not FORCE_OCR:
+            native_text = await loop.run_in_executor(RENDER_EXECUTOR, get_native_text, page)
+            if native_text:
+                log.debug("Using embedded text for page %d/%d of %s.", page_index, total_pages, pdf_filename)
+                return f"\n\n--- Page {page_index} ---\n\n", native_text
+
+        # Check the cache before rendering, so unchanged pages cost neither rendering nor an API call.
+        # Cache file I/O runs in the default executor to keep the event loop free.
+        cache_path = get_cache_path(pdf_digest, page_index, cache_folder)
+        extracted_text = await loop.run_in_executor(None, read_cached_text, cache_path)
+        if extracted_text is not None:
+            log.debug("Using cached text for page %d/%d of %s.", page_index, total_pages, pdf_filename)
+        else:
+            # Hold a render slot from rendering until the API call is done, so only a
+            # bounded number of rendered pages wait in memory for their turn at the API
+            async with RENDER_SLOTS:
+                img_data = await loop.run_in_executor(RENDER_EXECUTOR, render_page, page, pdfium_source)
 
                 # Extract text from the image data
-                extracted_text = extract_text_from_image_data(
+                extracted_text = await extract_text_from_image_data(
                     img_data,
                     INTERMEDIATE_MIME_TYPE,
                     model,
-                    current_page_index,
+                    page_index,
                     total_pages,
                     pdf_filename
                 )
+            if extracted_text is not None:
+                await loop.run_in_executor(None, write_cached_text, cache_path, extracted_text)
 
-                if extracted_text is not None:
-                    # Add a separator between pages for clarity in the output file
-                    page_separator = f"\n\n--- Page {current_page_index} ---\n\n"
-                    all_pages_text.append(page_separator + extracted_text)
-                else:
-                    # Log that a page was skipped but continue processing others
-                    print(f"    Skipping text from page {current_page_index} due to extraction issues.")
-                    all_pages_text.append(f"\n\n--- Page {current_page_index} (Error extracting text) ---\n\n")
+        if extracted_text is not None:
+            # Add a separator between pages for clarity in the output file
+            page_separator = f"\n\n--- Page {page_index} ---\n\n"
+            return page_separator, extracted_text
+        else:
+            # Log that a page was skipped but continue processing others
+            log.warning("Skipping text from page %d of %s due to extraction issues.", page_index, pdf_filename)
+            return f"\n\n--- Page {page_index} (Error extracting text) ---\n\n", ""
 
+    except Exception as page_e:
+        log.error("Error processing page %d of %s: %s", page_index, pdf_filename, page_e)
+        return f"\n\n--- Page {page_index} (Error processing page) ---\n\n", ""
 
-            except Exception as page_e:
-                print(f"  Error processing page {current_page_index} of {pdf_filename}: {page_e}")
-                all_pages_text.append(f"\n\n--- Page {current_page_index} (Error processing page) ---\n\n")
-                # Continue to the next page
 
-        # Close the document
-        doc.close()
+async def process_pdf_async(pdf_path, output_folder, model, progress=None):
+    """
+    Processes a single PDF file, extracts text from each page, and saves combined text.
 
-        # Combine text from all pages
-        final_text = "".join(all_pages_text).strip()
+    Args:
+        pdf_path (str): Path to the input PDF file.
+        output_folder (str): Path to the folder where the output text file will be saved.
+        model (genai.GenerativeModel): The configured Gemini model instance.
+        progress (tqdm, optional): Progress bar advanced once per finished page.
 
-        if not final_text:
-             print(f"Warning: No text could be extracted from any page of {pdf_filename}.")
-             # Decide if an empty file should be created or not. Here, we won't.
-             return False # Indicate failure if no text was extracted at all
+    Returns:
+        bool: True if processing was successful, False otherwise.
+    """
+    # Only a few PDFs are open at a time; each holds file handles (and its output
+    # file) until its last page is done, so opening every input at once exhausts fds
+    async with PDF_SLOTS:
+        pdf_filename = os.path.basename(pdf_path)
+        log.debug("Processing PDF: %s...", pdf_filename)
+        processed_successfully = False # Track overall success for this PDF
 
-        # Construct output path
-        base_name = os.path.splitext(pdf_filename)[0]
-        output_filename = f"{base_name}.txt"
-        output_path = os.path.join(output_folder, output_filename)
+        loop = asyncio.get_running_loop()
+        doc = None
+        pdfium_source = None
 
-        # Save the combined text to the output file
         try:
-            with open(output_path, "w", encoding="utf-8") as f:
-                f.write(final_text)
-            print(f"Successfully saved combined text to {output_path}")
-            processed_successfully = True
-        except IOError as e:
-            print(f"Error writing output file {output_path}: {e}")
-
-    except fitz.fitz.FileNotFoundError:
-         print(f"Error: PDF file not found at {pdf_path}")
-    except fitz.fitz.PasswordError:
-         print(f"Error: PDF file {pdf_filename} is password-protected. Skipping.")
-    except Exception as e:
-        print(f"An unexpected error occurred processing PDF {pdf_filename}: {e}")
-        # Ensure doc is closed if it was opened before the error
-        try:
-            if 'doc' in locals() and doc:
-                doc.close()
-        except Exception: pass # Ignore errors during cleanup closing
+            # Open the PDF document and load its pages on the render thread, since
+            # other PDFs may be rendering there concurrently
+            doc = await loop.run_in_executor(RENDER_EXECUTOR, fitz.open, pdf_path)
+            if doc.needs_pass:
+                log.error("PDF file %s is password-protected. Skipping.", pdf_filename)
+                return False
+            pages = await loop.run_in_executor(RENDER_EXECUTOR, list, doc)
+            # Opened on first render, so PDFs answered entirely from text layers never touch PDFium
+            pdfium_source = LazyPdfiumDocument(pdf_path)
+            total_pages = len(pages)
+            log.debug("Found %d page(s) in %s.", total_pages, pdf_filename)
+
+            if not total_pages:
+                 log.warning("No text could be extracted from any page of %s.", pdf_filename)
+                 # Decide if an empty file should be created or not. Here, we won't.
+                 return False # Indicate failure if no text was extracted at all
+
+            # Construct output path
+            base_name = os.path.splitext(pdf_filename)[0]
+            output_filename = f"{base_name}.txt"
+            output_path = os.path.join(output_folder, output_filename)
+            cache_folder = os.path.join(output_folder, CACHE_FOLDER_NAME)
+            pdf_digest = await loop.run_in_executor(None, hash_file, pdf_path)
+
+            # Process all pages concurrently, but write them in order: each page is written
+            # as soon as it and every page before it are done, so long jobs can be followed
+            # while they run and finished pages survive a crash.
+            tasks = [
+                asyncio.create_task(process_page(page, pdfium_source, model, cache_folder, pdf_digest, page_num + 1, total_pages, pdf_filename))
+                for page_num, page in enumerate(pages)
+            ]
+            if progress is not None:
+                # Pages are counted as their PDF is opened, so the total grows during the run
+                progress.total += total_pages
+                progress.refresh()
+                for task in tasks:
+                    task.add_done_callback(lambda t: t.cancelled() or progress.update())
+            try:
+                # Write encoded bytes, skipping the TextIOWrapper layer
+                with open(output_path, "wb", buffering=OUTPUT_BUFFER_SIZE) as f:
+                    for page_num, task in enumerate(tasks):
+                        page_separator, page_text = await task
+                        if page_num == 0:
+                            page_separator = page_separator.lstrip()
+                        f.write(page_separator.encode("utf-8"))
+                        f.write(page_text.encode("utf-8"))
+                        f.flush()
+                log.debug("Successfully saved combined text to %s", output_path)
+                processed_successfully = True
+            except IOError as e:
+                log.error("Error writing output file %s: %s", output_path, e)
+            finally:
+                # If writing failed part way through, stop the remaining pages
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+
+        except fitz.FileNotFoundError:
+             log.error("PDF file not found at %s", pdf_path)
+        except fitz.FileDataError:
+             log.error("PDF file %s is damaged or not a valid PDF. Skipping.", pdf_filename)
+        except Exception as e:
+            log.error("An unexpected error occurred processing PDF %s: %s", pdf_filename, e)
+        finally:
+            # Close the documents (on the render thread) whether or not processing succeeded
+            try:
+                if doc is not None:
+                    await loop.run_in_executor(RENDER_EXECUTOR, doc.close)
+                if pdfium_source is not None:
+                    await loop.run_in_executor(RENDER_EXECUTOR, pdfium_source.close)
+            except Exception: pass # Ignore errors during cleanup closing
+
+        return processed_successfully
+
+
+async def process_pdfs(pdf_paths, output_folder, model):
+    """
+    Processes a list of PDF files concurrently, with up to MAX_OPEN_PDFS open at
+    once. All pages of all PDFs share the global concurrency limit and rate
+    limiter, so the request pool stays full across document boundaries.
+
+    Args:
+        pdf_paths (list[str]): Paths to the input PDF files.
+        output_folder (str): Path to the folder where the output text files will be saved.
+        model (genai.GenerativeModel): The configured Gemini model instance.
+
+    Returns:
+        tuple[int, int]: The number of processed and skipped PDF files.
+    """
+    init_limits()
+    with tqdm(total=0, desc="OCR", unit="page") as progress:
+        # return_exceptions keeps one failing document from aborting the whole batch
+        results = await asyncio.gather(
+            *[process_pdf_async(p, output_folder, model, progress) for p in pdf_paths],
+            return_exceptions=True
+        )
 
-    return processed_successfully
+    for pdf_path, result in zip(pdf_paths, results):
+        if isinstance(result, BaseException):
+            log.error("An unexpected error occurred processing PDF %s: %s", os.path.basename(pdf_path), result)
+    processed_count = sum(1 for result in results if result is True)
+    return processed_count, len(results) - processed_count
 
 
 def main():
     """
     Main function to iterate through PDFs, extract text, and save results.
     """
+    # --- Configuration Validation ---
+    if LOG_LEVEL not in LOG_LEVELS:
+        print(f"Error: LOG_LEVEL must be one of {', '.join(LOG_LEVELS)}.")
+        sys.exit(1)
+    if MAX_CONCURRENCY is None or MAX_CONCURRENCY < 1:
+        print("Error: GEMINI_MAX_CONCURRENCY must be a whole number of at least 1.")
+        sys.exit(1)
+    if REQUESTS_PER_MINUTE is None or not REQUESTS_PER_MINUTE > 0:
+        print("Error: GEMINI_RPM must be a number greater than 0.")
+        sys.exit(1)
+
+    # Only this script's logger follows LOG_LEVEL; libraries keep the default (WARNING)
+    logging.basicConfig(format="%(levelname)s: %(message)s")
+    log.setLevel(LOG_LEVEL)
+
     # --- API Key and Client Setup ---
     api_key = os.environ.get("GEMINI_API_KEY")
     if not api_key:
@@ -210,6 +681,8 @@ def main():
         sys.exit(1)
 
     try:
+        # Plain API-key auth never needs mutual TLS; skip the client-certificate endpoint lookup
+        os.environ.setdefault("GOOGLE_API_USE_MTLS_ENDPOINT", "never")
         genai.configure(api_key=api_key)
         # Configure safety settings if needed (e.g., to be less strict for assignments)
         # safety_settings = [
@@ -219,6 +692,9 @@ def main():
         #     {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
         # ]
         # model = genai.GenerativeModel(MODEL_NAME, safety_settings=safety_settings)
+        # This single model instance is shared by every page task. Its async client is
+        # created once and uses one grpc_asyncio channel, so all concurrent requests are
+        # multiplexed over the same HTTP/2 connection instead of each opening its own.
         model = genai.GenerativeModel(MODEL_NAME)
         print(f"Using Gemini model: {MODEL_NAME}")
     except Exception as e:
@@ -241,24 +717,18 @@ def main():
 
     # --- Process PDFs ---
     print(f"\nScanning for PDF files in '{INPUT_FOLDER}'...")
-    processed_count = 0
-    skipped_count = 0
-
-    for filename in os.listdir(INPUT_FOLDER):
-        input_path = os.path.join(INPUT_FOLDER, filename)
-        file_ext = os.path.splitext(filename)[1].lower()
-
-        # Check if it's a file and has the target PDF extension
-        if os.path.isfile(input_path) and file_ext == INPUT_EXTENSION:
-            if process_pdf(input_path, OUTPUT_FOLDER, model):
-                processed_count += 1
-            else:
-                skipped_count += 1
-        elif os.path.isfile(input_path):
-             # Optional: Log skipped non-PDF files
-             # print(f"Skipping non-PDF file: {filename}")
-             pass
-
+    # scandir caches file type info, avoiding an extra stat() per entry.
+    # Non-PDF files are skipped silently.
+    with os.scandir(INPUT_FOLDER) as entries:
+        pdf_paths = [
+            entry.path for entry in entries
+            if entry.is_file() and entry.name.lower().endswith(INPUT_EXTENSION)
+        ]
+
+    print(f"Using up to {MAX_CONCURRENCY} concurrent API requests, {REQUESTS_PER_MINUTE:g} per minute.")
+    # Route log messages through tqdm so they do not break the progress bar
+    with logging_redirect_tqdm():
+        processed_count, skipped_count = asyncio.run(process_pdfs(pdf_paths, OUTPUT_FOLDER, model))
 
     print("\n--- Processing Complete ---")
     print(f"Successfully processed: {processed_count} PDF files.")